@@ -9,6 +9,8 @@ import logging
 import textwrap
 from glob import glob
 from parcp.cpimages import CellProfilerImages
+from parcp.scheduler import BatchScheduler, MEGABYTE
+from parcp.telemetry import ProgressTracker, MetricsServer
 
 
 logger = logging.getLogger('parcp')
@@ -140,6 +142,11 @@ class ParallelCellProfiler(object):
             raise Exception('Failed (exit_code %d) to run: %s' %
                             (result.exit_code, command_code))
 
+    def get_image_groups(self):
+        image_groups = glob(os.path.join(self.project.image_groups_path,
+                            'image_set_*.csv'))
+        return sorted(image_groups)
+
     def run_batches(self, pipeline_filename):
         '''
         For each input CSV file found run a CP2 job and produce output.
@@ -147,15 +154,56 @@ class ParallelCellProfiler(object):
         of next step - merging of results.
         '''
         pipeline_filepath = os.path.join(self.project.path, pipeline_filename)
-        image_groups = glob(os.path.join(self.project.image_groups_path,
-                            'image_set_*.csv'))
-        image_groups = sorted(image_groups)
+        image_groups = self.get_image_groups()
         for group_index, image_group in enumerate(image_groups):
             # group index is appended to output path of each batch to help
             # differentiate outputs per job in merging of results after the
             # parallel step.
             self.run_batch(pipeline_filepath, group_index, image_group)
 
+    def run_batches_in_parallel(self, pipeline_filename, max_workers=None,
+                                memory_budget=None, metrics_port=None):
+        '''
+        Same as run_batches, but CP2 jobs are run in parallel as long as
+        their projected memory usage fits into the memory budget (bytes).
+        Defaults can be given in the grouping settings as 'max_workers',
+        'memory_budget_mb' and 'image_set_memory_mb' (initial guess of peak
+        RSS per image set, otherwise learned from the first batch).
+
+        Progress is written to 'results/status.json'. If metrics_port (or
+        'metrics_port' setting) is given, metrics are also served in
+        Prometheus text format on http://127.0.0.1:<port>/metrics.
+        '''
+        settings = self.cpimages.settings
+        if max_workers is None and 'max_workers' in settings:
+            max_workers = int(settings['max_workers'])
+        if memory_budget is None and 'memory_budget_mb' in settings:
+            memory_budget = int(settings['memory_budget_mb']) * MEGABYTE
+        image_set_memory = None
+        if 'image_set_memory_mb' in settings:
+            image_set_memory = int(settings['image_set_memory_mb']) * MEGABYTE
+        if metrics_port is None and 'metrics_port' in settings:
+            metrics_port = int(settings['metrics_port'])
+        pipeline_filepath = os.path.join(self.project.path, pipeline_filename)
+        scheduler = BatchScheduler(self, pipeline_filepath,
+                                   max_workers=max_workers,
+                                   memory_budget=memory_budget,
+                                   image_set_memory=image_set_memory)
+        scheduler.tracker = ProgressTracker(
+            os.path.join(self.project.results_path, 'status.json'),
+            scheduler.max_workers)
+        for group_index, image_group in enumerate(self.get_image_groups()):
+            scheduler.add_batch(group_index, image_group)
+        metrics_server = None
+        if metrics_port is not None:
+            metrics_server = MetricsServer(scheduler.tracker, metrics_port)
+            metrics_server.start()
+        try:
+            scheduler.run()
+        finally:
+            if metrics_server is not None:
+                metrics_server.stop()
+
     def merge_image_results(self):
         '''
         Special case - merge measurements of image for all results.
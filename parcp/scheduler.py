@@ -0,0 +1,428 @@
+'''
+Memory-aware scheduling of CellProfiler2 batches.
+
+Each batch is a CP2 process working on a CSV list of image sets. Peak memory
+of a process grows with the images it handles, so instead of running one
+worker per core the scheduler learns peak RSS by number of image sets from
+completed batches and admits new batches only while the projected usage fits
+into a memory budget. Batches killed by the OOM killer are split in halves and
+queued again.
+'''
+import os
+import re
+import sys
+import time
+import signal
+import shutil
+import logging
+import subprocess
+import multiprocessing
+from collections import deque
+
+
+logger = logging.getLogger('parcp.scheduler')
+
+MEGABYTE = 1024 * 1024
+
+# Output folders of batches (and halves of re-split ones) inside results.
+BATCH_OUTPUT_EXPR = re.compile(r'^(\d+(_\d+)*|\.renumber_\d+)$')
+
+
+def read_proc_kilobytes(filepath, key):
+    '''
+    Read a value given in kB (e.g. 'MemAvailable' in /proc/meminfo or
+    'VmHWM' in /proc/<pid>/status) and return it in bytes. Returns None if
+    the value is unavailable, e.g. on OS-X or when the process is gone.
+    '''
+    try:
+        with open(filepath) as stream:
+            for line in stream:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def get_available_memory():
+    return read_proc_kilobytes('/proc/meminfo', 'MemAvailable')
+
+
+class Batch(object):
+    '''
+    A single run of CP2 on a CSV list of image sets. Label is used to name
+    the output folder inside results; halves of a re-split batch get the
+    parent label with a suffix.
+    '''
+
+    def __init__(self, label, csv_path, output_path):
+        self.label = label
+        self.csv_path = csv_path
+        self.output_path = output_path
+        self.image_set_count = self.count_image_sets()
+        self.process = None
+        self.returncode = None
+        self.peak_rss = 0
+        self.current_rss = 0
+        self.exclusive = False
+        self.ran_alone = False
+        self.start_time = None
+        self.end_time = None
+        self._log_files = list()
+
+    def count_image_sets(self):
+        # First line is a header, each other line is an image set.
+        with open(self.csv_path) as stream:
+            return max(0, sum(1 for line in stream if line.strip()) - 1)
+
+    def update_rss(self):
+        '''
+        Sample current RSS of the running process. It is only used to
+        account for batches growing beyond their projection; the peak is
+        taken from the kernel once the process is reaped.
+        '''
+        status_path = '/proc/%d/status' % self.process.pid
+        current_rss = read_proc_kilobytes(status_path, 'VmRSS')
+        if current_rss is not None:
+            self.current_rss = current_rss
+            self.peak_rss = max(self.peak_rss, current_rss)
+
+    def reap(self):
+        '''
+        Collect the process if it has exited. Returns True once it did. Peak
+        RSS is read from the resource usage reported by wait4, so memory
+        allocated after the last sample is not missed.
+        '''
+        pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        # Let Popen know the process is gone, so it does not wait on it.
+        self.process.returncode = self.returncode
+        max_rss = rusage.ru_maxrss
+        if not sys.platform.startswith('darwin'):
+            # Linux reports kilobytes, OS-X bytes.
+            max_rss *= 1024
+        self.peak_rss = max(self.peak_rss, max_rss)
+        return True
+
+    def start(self, command_code, start_time):
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+        stdoutlog = open(os.path.join(self.output_path, 'stdout.log'), 'w')
+        stdouterr = open(os.path.join(self.output_path, 'stderr.log'), 'w')
+        self._log_files = [stdoutlog, stdouterr]
+        args = [arg for arg in command_code.split(' ') if len(arg) > 0]
+        self.start_time = start_time
+        try:
+            self.process = subprocess.Popen(args, stdout=stdoutlog,
+                                            stderr=stdouterr)
+        except Exception:
+            self.finish(start_time)
+            raise
+
+    def terminate(self):
+        '''Stop the process and wait for it to exit.'''
+        try:
+            self.process.terminate()
+        except OSError:
+            # Already exited.
+            pass
+        self.returncode = self.process.wait()
+
+    def finish(self, end_time):
+        self.end_time = end_time
+        for log_file in self._log_files:
+            log_file.close()
+        self._log_files = list()
+
+    @property
+    def was_oom_killed(self):
+        # The kernel OOM killer terminates its victim with SIGKILL.
+        return self.returncode == -signal.SIGKILL
+
+    def split(self, output_root, resplit_path):
+        '''
+        Split the CSV list of image sets into two halves, each becoming a
+        new batch. Order of image sets is preserved.
+        '''
+        with open(self.csv_path) as stream:
+            lines = [line for line in stream if line.strip()]
+        header, rows = lines[0], lines[1:]
+        middle = len(rows) // 2
+        name = os.path.splitext(os.path.basename(self.csv_path))[0]
+        if not os.path.exists(resplit_path):
+            os.makedirs(resplit_path)
+        halves = list()
+        for half_index, half_rows in enumerate((rows[:middle],
+                                                rows[middle:])):
+            label = '%s_%d' % (self.label, half_index)
+            csv_path = os.path.join(resplit_path,
+                                    '%s_%d.csv' % (name, half_index))
+            with open(csv_path, 'w') as stream:
+                stream.writelines([header] + half_rows)
+            halves.append(Batch(label, csv_path,
+                                os.path.join(output_root, label)))
+        return halves
+
+
+class MemoryEstimator(object):
+    '''
+    Learn peak RSS of CP2 batches by number of image sets from completed
+    batches. Each process has a large constant cost (Python, Java and the
+    pipeline), so peak RSS is not proportional to the number of image sets.
+    Peak only grows with it though: a batch is projected to need at least
+    the peak of any batch of as many or more image sets, and linearly scaled
+    peaks of smaller batches. This overestimates small batches, e.g. halves
+    of a re-split one, which errs on the safe side.
+
+    Until anything is observed, an optional initial guess of peak RSS per
+    image set is scaled linearly.
+    '''
+
+    def __init__(self, per_image_set=None):
+        self.per_image_set = per_image_set
+        # Largest peak RSS observed, by number of image sets.
+        self.peaks = dict()
+
+    def observe(self, batch):
+        if batch.image_set_count == 0 or batch.peak_rss == 0:
+            return
+        count = batch.image_set_count
+        if batch.peak_rss > self.peaks.get(count, 0):
+            logger.info('Peak RSS of a batch of %d image sets: %.1f MB',
+                        count, batch.peak_rss / float(MEGABYTE))
+            self.peaks[count] = batch.peak_rss
+
+    def project(self, batch):
+        count = max(1, batch.image_set_count)
+        if not self.peaks:
+            if self.per_image_set is None:
+                return None
+            return self.per_image_set * count
+        return max(peak if count <= observed_count
+                   else peak * count / float(observed_count)
+                   for observed_count, peak in self.peaks.items())
+
+
+class BatchScheduler(object):
+    '''
+    Run CP2 batches in parallel within a memory budget.
+
+    Until the first batch completes nothing is known about memory usage, so
+    only a single (probe) batch is run, unless an initial estimate per image
+    set is given. A batch is always admitted if nothing else is running.
+    Batches killed by the OOM killer are split in halves and re-queued; a
+    single image set batch is retried once running alone, unless it was
+    already running alone when killed.
+    '''
+
+    def __init__(self, runner, pipeline_filepath, max_workers=None,
+                 memory_budget=None, image_set_memory=None,
+                 poll_interval=1.0, tracker=None):
+        self.runner = runner
+        self.pipeline_filepath = pipeline_filepath
+        if max_workers is None:
+            max_workers = multiprocessing.cpu_count()
+        if max_workers < 1:
+            raise Exception('At least one worker is required to run batches,'
+                            ' got max_workers=%d' % max_workers)
+        self.max_workers = max_workers
+        if memory_budget is None:
+            available_memory = get_available_memory()
+            if available_memory is not None:
+                # Leave some headroom for the rest of the system.
+                memory_budget = int(available_memory * 0.9)
+            else:
+                logger.warn('Can not learn available memory. Memory budget'
+                            ' is not enforced.')
+        self.memory_budget = memory_budget
+        self.estimator = MemoryEstimator(image_set_memory)
+        self.poll_interval = poll_interval
+        self.tracker = tracker
+        self.batches = list()
+        self.queue = deque()
+        self.running = list()
+        self.failed = list()
+        self.has_resplit = False
+
+    @property
+    def results_path(self):
+        return self.runner.project.results_path
+
+    @property
+    def resplit_path(self):
+        return os.path.join(self.runner.project.image_groups_path,
+                            'resplit')
+
+    def add_batch(self, group_index, image_group):
+        batch = Batch(str(group_index), image_group,
+                      os.path.join(self.results_path, str(group_index)))
+        self.batches.append(batch)
+        self.queue.append(batch)
+        if self.tracker is not None:
+            self.tracker.batch_queued(batch)
+        return batch
+
+    def projected_usage(self, batch):
+        projected = self.estimator.project(batch)
+        if projected is None:
+            return batch.current_rss
+        return max(batch.current_rss, projected)
+
+    def can_admit(self, batch):
+        if not self.running:
+            return True
+        if batch.exclusive or any(other.exclusive for other in self.running):
+            return False
+        if len(self.running) >= self.max_workers:
+            return False
+        if self.memory_budget is None:
+            return True
+        projected = self.estimator.project(batch)
+        if projected is None:
+            # Still waiting for the probe batch.
+            return False
+        used = sum(self.projected_usage(other) for other in self.running)
+        return used + projected <= self.memory_budget
+
+    def start(self, batch):
+        logger.info('Running cp2 with image group: %s', batch.csv_path)
+        command_code = self.runner.get_cp2_batch_command(
+            self.pipeline_filepath, batch.csv_path, batch.output_path)
+        batch.start(command_code, time.time())
+        batch.ran_alone = not self.running
+        for other in self.running:
+            other.ran_alone = False
+        self.running.append(batch)
+        if self.tracker is not None:
+            self.tracker.batch_started(batch)
+            self.publish(force=True)
+
+    def resplit(self, batch):
+        halves = batch.split(self.results_path, self.resplit_path)
+        logger.warn('Batch %s was OOM-killed. Splitting %d image sets into'
+                    ' batches %s', batch.label, batch.image_set_count,
+                    ', '.join(half.label for half in halves))
+        # Partial output of the killed batch must not be merged.
+        shutil.rmtree(batch.output_path, ignore_errors=True)
+        position = self.batches.index(batch)
+        self.batches[position:position + 1] = halves
+        self.queue.extendleft(reversed(halves))
+        self.has_resplit = True
+
+    def handle_result(self, batch):
+        '''
+        Learn from a finished batch and decide what happens next. Returns
+        the resulting state: 'done', 'failed', 'resplit' or 'retried'.
+        '''
+        returncode = batch.returncode
+        if returncode == 0:
+            self.estimator.observe(batch)
+            logger.info('Done batch %s (peak RSS %.1f MB)', batch.label,
+                        batch.peak_rss / float(MEGABYTE))
+            return 'done'
+        if batch.was_oom_killed:
+            # Observed peak is only a lower bound, but still worth learning.
+            self.estimator.observe(batch)
+            if batch.image_set_count > 1:
+                self.resplit(batch)
+                return 'resplit'
+            if not batch.exclusive and not batch.ran_alone:
+                logger.warn('Batch %s was OOM-killed. Retrying it alone.',
+                            batch.label)
+                batch.exclusive = True
+                self.queue.appendleft(batch)
+                return 'retried'
+        logger.error('Failed (exit_code %d) batch %s: %s', returncode,
+                     batch.label, batch.csv_path)
+        self.failed.append(batch)
+        return 'failed'
+
+    def complete(self, batch):
+        batch.finish(time.time())
+        self.running.remove(batch)
+        state = self.handle_result(batch)
+        if self.tracker is not None:
+            self.tracker.batch_finished(batch, state)
+            self.publish(force=True)
+
+    def publish(self, force=False):
+        if self.tracker is not None:
+            self.tracker.publish(len(self.queue), len(self.running),
+                                 force=force)
+
+    def poll(self):
+        for batch in list(self.running):
+            batch.update_rss()
+            if batch.reap():
+                self.complete(batch)
+
+    def check_results_path(self):
+        '''
+        Renumbering output folders after re-splitting would clash with
+        folders left by an earlier run, so refuse to start instead of
+        failing at the very end.
+        '''
+        if not os.path.exists(self.results_path):
+            return
+        stale_folders = sorted(
+            name for name in os.listdir(self.results_path)
+            if BATCH_OUTPUT_EXPR.match(name))
+        if stale_folders:
+            raise Exception('Results of an earlier run found in %s: %s. '
+                            'Remove them before running batches.' %
+                            (self.results_path, ', '.join(stale_folders)))
+
+    def renumber_results(self):
+        '''
+        Merging of results expects consecutive numeric output folders. Give
+        them back in order of image sets after some batches were re-split.
+        '''
+        for index, batch in enumerate(self.batches):
+            temp_path = os.path.join(self.results_path, '.renumber_%d' % index)
+            os.rename(batch.output_path, temp_path)
+            batch.output_path = temp_path
+        for index, batch in enumerate(self.batches):
+            output_path = os.path.join(self.results_path, str(index))
+            os.rename(batch.output_path, output_path)
+            batch.output_path = output_path
+
+    def terminate_running(self):
+        '''
+        Stop batches left running when the run is aborted, so that no CP2
+        process outlives it.
+        '''
+        for batch in list(self.running):
+            logger.warn('Terminating batch %s', batch.label)
+            batch.terminate()
+            batch.finish(time.time())
+            self.running.remove(batch)
+            self.failed.append(batch)
+            if self.tracker is not None:
+                self.tracker.batch_finished(batch, 'failed')
+        self.publish(force=True)
+
+    def run(self):
+        self.check_results_path()
+        try:
+            while self.queue or self.running:
+                self.poll()
+                while self.queue and self.can_admit(self.queue[0]):
+                    self.start(self.queue.popleft())
+                self.publish()
+                if self.running:
+                    time.sleep(self.poll_interval)
+        except BaseException:
+            # Including KeyboardInterrupt.
+            self.terminate_running()
+            raise
+        self.publish(force=True)
+        if self.failed:
+            raise Exception('Failed to run batches: %s' % ', '.join(
+                batch.csv_path for batch in self.failed))
+        if self.has_resplit:
+            self.renumber_results()
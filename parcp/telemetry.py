@@ -0,0 +1,198 @@
+'''
+Progress and throughput telemetry of parallel CP2 runs.
+
+The tracker is fed by the scheduler on every batch start and completion. It
+keeps a small snapshot of counters which is periodically rewritten as a JSON
+status file and can be served on localhost in Prometheus text format.
+'''
+import os
+import json
+import time
+import logging
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+logger = logging.getLogger('parcp.telemetry')
+
+
+class ProgressTracker(object):
+    '''
+    Count batches and image sets by state and account busy time per worker
+    slot. Only counters are updated per event, so publishing is cheap enough
+    to be done on every batch completion.
+    '''
+
+    def __init__(self, status_path, max_workers, write_interval=10.0):
+        self.status_path = status_path
+        self.write_interval = write_interval
+        self.start_time = time.time()
+        self.last_write_time = None
+        self.batch_counts = {'done': 0, 'failed': 0, 'resplit': 0,
+                             'retried': 0}
+        self.image_set_counts = {'total': 0, 'done': 0, 'failed': 0}
+        self.worker_busy_time = [0.0] * max_workers
+        self.worker_batches = [None] * max_workers
+        # Replaced as a whole on publish, so it is safe to read from the
+        # metrics server thread.
+        self.snapshot = self.make_snapshot(0, 0)
+
+    def batch_queued(self, batch):
+        self.image_set_counts['total'] += batch.image_set_count
+
+    def batch_started(self, batch):
+        # Scheduler never runs more batches than there are worker slots.
+        assert None in self.worker_batches
+        worker = self.worker_batches.index(None)
+        self.worker_batches[worker] = batch
+
+    def batch_finished(self, batch, state):
+        '''State is one of 'done', 'failed', 'resplit' or 'retried'.'''
+        worker = self.worker_batches.index(batch)
+        self.worker_batches[worker] = None
+        self.worker_busy_time[worker] += batch.end_time - batch.start_time
+        self.batch_counts[state] += 1
+        if state in ('done', 'failed'):
+            self.image_set_counts[state] += batch.image_set_count
+
+    def make_snapshot(self, queued, running):
+        now = time.time()
+        elapsed = max(now - self.start_time, 1e-6)
+        image_sets_per_second = self.image_set_counts['done'] / elapsed
+        remaining = self.image_set_counts['total'] \
+            - self.image_set_counts['done'] - self.image_set_counts['failed']
+        eta = None
+        if image_sets_per_second > 0:
+            eta = remaining / image_sets_per_second
+        workers = list()
+        for worker, batch in enumerate(self.worker_batches):
+            busy_time = self.worker_busy_time[worker]
+            if batch is not None:
+                busy_time += now - batch.start_time
+            workers.append({
+                'worker': worker,
+                'batch': batch.label if batch is not None else None,
+                'utilization': min(1.0, busy_time / elapsed),
+            })
+        batches = {'queued': queued, 'running': running}
+        batches.update(self.batch_counts)
+        return {
+            'updated': now,
+            'elapsed_seconds': elapsed,
+            'batches': batches,
+            'image_sets': dict(self.image_set_counts),
+            'image_sets_per_second': image_sets_per_second,
+            'eta_seconds': eta,
+            'workers': workers,
+        }
+
+    def publish(self, queued, running, force=False):
+        '''
+        Refresh the snapshot. Status file is rewritten on force (i.e. on
+        batch events) or once write_interval has passed.
+        '''
+        self.snapshot = self.make_snapshot(queued, running)
+        if not force and self.last_write_time is not None and \
+                self.snapshot['updated'] - self.last_write_time \
+                < self.write_interval:
+            return
+        self.last_write_time = self.snapshot['updated']
+        self.write_status()
+
+    def write_status(self):
+        output_path = os.path.dirname(self.status_path)
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        # Write aside and rename, so readers never see a partial file.
+        temp_path = self.status_path + '.tmp'
+        with open(temp_path, 'w') as stream:
+            json.dump(self.snapshot, stream, indent=2, sort_keys=True)
+        os.rename(temp_path, self.status_path)
+
+    def format_metrics(self):
+        '''Render the latest snapshot in Prometheus text format.'''
+        snapshot = self.snapshot
+        lines = list()
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP parcp_%s %s' % (name, help_text))
+            lines.append('# TYPE parcp_%s %s' % (name, metric_type))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                lines.append('parcp_%s%s %s' % (name, labels, repr(value)))
+
+        batches = snapshot['batches']
+        image_sets = snapshot['image_sets']
+        add_metric('batches', 'gauge',
+                   'Number of CP2 batches queued or running.',
+                   [('{state="%s"}' % state, batches[state])
+                    for state in ('queued', 'running')])
+        add_metric('batches_finished_total', 'counter',
+                   'Number of finished CP2 batches by outcome.',
+                   [('{state="%s"}' % state, batches[state])
+                    for state in ('done', 'failed', 'resplit', 'retried')])
+        add_metric('image_sets', 'gauge',
+                   'Number of image sets to process in this run.',
+                   [('', image_sets['total'])])
+        add_metric('image_sets_processed_total', 'counter',
+                   'Number of processed image sets by outcome.',
+                   [('{state="%s"}' % state, image_sets[state])
+                    for state in ('done', 'failed')])
+        add_metric('image_sets_per_second', 'gauge',
+                   'Image sets processed per second since start.',
+                   [('', snapshot['image_sets_per_second'])])
+        add_metric('eta_seconds', 'gauge',
+                   'Estimated time left to process all image sets.',
+                   [('', snapshot['eta_seconds'])])
+        add_metric('elapsed_seconds', 'gauge', 'Time since start of the run.',
+                   [('', snapshot['elapsed_seconds'])])
+        add_metric('worker_utilization', 'gauge',
+                   'Fraction of elapsed time a worker slot was busy.',
+                   [('{worker="%d"}' % worker['worker'],
+                     worker['utilization'])
+                    for worker in snapshot['workers']])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.tracker.format_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer(object):
+    '''
+    Serve metrics of the tracker over HTTP on localhost from a daemon thread.
+    '''
+
+    def __init__(self, tracker, port, host='127.0.0.1'):
+        self.server = HTTPServer((host, port), MetricsRequestHandler)
+        self.server.tracker = tracker
+        self.thread = None
+
+    def start(self):
+        logger.info('Serving metrics on http://%s:%d/metrics',
+                    *self.server.server_address[:2])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
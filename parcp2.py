@@ -25,5 +25,5 @@ if __name__ == '__main__':
     runner = ParallelCellProfiler(project_path)
     runner.load_image_setting('image_groups.json')
     runner.split_images()
-    runner.run_batches('ExampleFly.cppipe')
+    runner.run_batches_in_parallel('ExampleFly.cppipe')
     runner.merge_results()
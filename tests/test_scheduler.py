@@ -0,0 +1,208 @@
+import os
+import sys
+import signal
+import shutil
+import tempfile
+import unittest
+from parcp import ParallelCellProfiler
+from parcp.scheduler import BatchScheduler, MEGABYTE
+
+
+class FakeCellProfiler(ParallelCellProfiler):
+    '''
+    Stub CP2 by a shell script chosen per image set list. Script is given
+    the paths of the CSV list and of the output folder.
+    '''
+
+    def __init__(self, project_path, make_script):
+        super(FakeCellProfiler, self).__init__(project_path)
+        self.make_script = make_script
+        self.calls = list()
+
+    def get_cp2_batch_command(self, cp_pipeline_file, input_csv_filepath,
+                              output_path):
+        self.calls.append(os.path.basename(input_csv_filepath))
+        script = self.make_script(input_csv_filepath, output_path)
+        if script.startswith(sys.executable):
+            return script
+        # Command is split by spaces, let the shell split it instead.
+        return 'sh -c ' + script.replace(' ', '${IFS}')
+
+
+def count_image_sets(csv_path):
+    with open(csv_path) as stream:
+        return len(stream.readlines()) - 1
+
+
+def copy_list(csv_path, output_path):
+    return 'cp %s %s/image_set.csv' % (csv_path, output_path)
+
+
+def oom_kill(csv_path, output_path):
+    return 'kill -9 $$'
+
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.project_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.project_path, 'image_groups'))
+        self.rows = list()
+
+    def tearDown(self):
+        shutil.rmtree(self.project_path)
+
+    def write_image_sets(self, sizes):
+        for set_num, size in enumerate(sizes):
+            csv_path = os.path.join(self.project_path, 'image_groups',
+                                    'image_set_%d.csv' % set_num)
+            rows = ['img_%03d.tif\n' % (len(self.rows) + row_num)
+                    for row_num in range(size)]
+            self.rows.extend(rows)
+            with open(csv_path, 'w') as stream:
+                stream.writelines(['Image_FileName_OrigBlue\n'] + rows)
+
+    def make_scheduler(self, make_script, **kwargs):
+        runner = FakeCellProfiler(self.project_path, make_script)
+        kwargs.setdefault('max_workers', 2)
+        kwargs.setdefault('memory_budget', 1024 * MEGABYTE)
+        scheduler = BatchScheduler(runner, 'pipeline.cppipe',
+                                   poll_interval=0.05, **kwargs)
+        for group_index, image_group in enumerate(runner.get_image_groups()):
+            scheduler.add_batch(group_index, image_group)
+        return scheduler
+
+    @property
+    def results_path(self):
+        return os.path.join(self.project_path, 'results')
+
+    def test_oom_killed_batch_is_split_and_renumbered(self):
+        self.write_image_sets([3, 3, 3])
+
+        def make_script(csv_path, output_path):
+            if 'image_set_1' in csv_path and count_image_sets(csv_path) > 1:
+                return oom_kill(csv_path, output_path)
+            return copy_list(csv_path, output_path)
+
+        scheduler = self.make_scheduler(make_script)
+        scheduler.run()
+
+        # 1 -> 1_0 (1 set), 1_1 (2 sets) -> 1_1_0, 1_1_1
+        self.assertEqual([batch.label for batch in scheduler.batches],
+                         ['0', '1_0', '1_1_0', '1_1_1', '2'])
+        self.assertEqual(sorted(os.listdir(self.results_path)),
+                         ['0', '1', '2', '3', '4'])
+        merged_rows = list()
+        for index in range(5):
+            with open(os.path.join(self.results_path, str(index),
+                                   'image_set.csv')) as stream:
+                merged_rows.extend(stream.readlines()[1:])
+        self.assertEqual(merged_rows, self.rows)
+
+    def test_single_image_set_is_retried_alone_then_failed(self):
+        self.write_image_sets([1, 1])
+
+        def make_script(csv_path, output_path):
+            if csv_path.endswith('image_set_1.csv'):
+                return oom_kill(csv_path, output_path)
+            return 'sleep 1; ' + copy_list(csv_path, output_path)
+
+        # Known estimate admits both batches at once.
+        scheduler = self.make_scheduler(make_script,
+                                        image_set_memory=MEGABYTE)
+        self.assertRaises(Exception, scheduler.run)
+        self.assertEqual(scheduler.runner.calls.count('image_set_1.csv'), 2)
+        self.assertEqual([batch.label for batch in scheduler.failed], ['1'])
+
+    def test_batch_killed_running_alone_is_not_retried(self):
+        self.write_image_sets([1])
+        scheduler = self.make_scheduler(oom_kill)
+        self.assertRaises(Exception, scheduler.run)
+        self.assertEqual(scheduler.runner.calls, ['image_set_0.csv'])
+
+    def test_no_parallel_admission_before_estimate(self):
+        self.write_image_sets([1, 1])
+        scheduler = self.make_scheduler(copy_list)
+        first, second = scheduler.batches
+        self.assertTrue(scheduler.can_admit(first))
+        scheduler.running.append(first)
+        self.assertFalse(scheduler.can_admit(second))
+        scheduler.estimator.per_image_set = MEGABYTE
+        self.assertTrue(scheduler.can_admit(second))
+
+    def test_memory_budget_is_enforced(self):
+        self.write_image_sets([1, 1, 1, 2])
+        scheduler = self.make_scheduler(copy_list, max_workers=4,
+                                        memory_budget=250 * MEGABYTE,
+                                        image_set_memory=100 * MEGABYTE)
+        first, second, third, fourth = scheduler.batches
+        scheduler.running.append(first)
+        self.assertTrue(scheduler.can_admit(second))
+        self.assertFalse(scheduler.can_admit(fourth))
+        scheduler.running.append(second)
+        self.assertFalse(scheduler.can_admit(third))
+        # Batch growing beyond its projection takes up the rest.
+        scheduler.running.remove(second)
+        first.current_rss = 200 * MEGABYTE
+        self.assertFalse(scheduler.can_admit(second))
+
+    def test_estimate_of_big_batch_gates_its_halves(self):
+        self.write_image_sets([10, 5, 5])
+        scheduler = self.make_scheduler(copy_list, max_workers=4,
+                                        memory_budget=4000 * MEGABYTE)
+        big, first_half, second_half = scheduler.batches
+        # Most of the peak is the constant cost of a CP2 process.
+        big.peak_rss = 3000 * MEGABYTE
+        scheduler.estimator.observe(big)
+        self.assertEqual(scheduler.estimator.project(first_half),
+                         3000 * MEGABYTE)
+        self.assertEqual(scheduler.estimator.project(big), 3000 * MEGABYTE)
+        scheduler.running.append(first_half)
+        self.assertFalse(scheduler.can_admit(second_half))
+        # Bigger batches than observed are scaled up.
+        second_half.peak_rss = 2000 * MEGABYTE
+        scheduler.estimator.observe(second_half)
+        self.assertEqual(scheduler.estimator.project(big), 4000 * MEGABYTE)
+
+    def test_peak_rss_after_last_sample_is_learned(self):
+        self.write_image_sets([1])
+
+        def make_script(csv_path, output_path):
+            return sys.executable + ' -c x=bytearray(%d)' % (64 * MEGABYTE)
+
+        scheduler = self.make_scheduler(make_script)
+        scheduler.poll_interval = 0.5
+        scheduler.run()
+        batch = scheduler.batches[0]
+        self.assertTrue(batch.peak_rss >= 64 * MEGABYTE)
+        self.assertTrue(scheduler.estimator.project(batch) >= 64 * MEGABYTE)
+
+    def test_running_batches_are_terminated_on_error(self):
+        self.write_image_sets([1, 1])
+
+        def make_script(csv_path, output_path):
+            if csv_path.endswith('image_set_1.csv'):
+                raise IOError('Failed to build the command')
+            return sys.executable + ' -c __import__("time").sleep(30)'
+
+        scheduler = self.make_scheduler(make_script,
+                                        image_set_memory=MEGABYTE)
+        self.assertRaises(IOError, scheduler.run)
+        first = scheduler.batches[0]
+        self.assertEqual(scheduler.running, [])
+        self.assertEqual(first.returncode, -signal.SIGTERM)
+        self.assertEqual(first._log_files, [])
+        self.assertEqual(scheduler.failed, [first])
+
+    def test_no_workers_are_refused(self):
+        self.write_image_sets([1])
+        self.assertRaises(Exception, self.make_scheduler, copy_list,
+                          max_workers=0)
+
+    def test_stale_results_are_refused(self):
+        self.write_image_sets([1])
+        os.makedirs(os.path.join(self.results_path, '3'))
+        runner = FakeCellProfiler(self.project_path, copy_list)
+        self.assertRaises(Exception, runner.run_batches_in_parallel,
+                          'pipeline.cppipe', max_workers=1)
+        self.assertEqual(runner.calls, [])
@@ -0,0 +1,85 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+from parcp.telemetry import ProgressTracker, MetricsServer
+
+
+class FakeBatch(object):
+
+    def __init__(self, label, image_set_count):
+        self.label = label
+        self.image_set_count = image_set_count
+        self.start_time = None
+        self.end_time = None
+
+
+class TelemetryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.results_path = tempfile.mkdtemp()
+        self.status_path = os.path.join(self.results_path, 'status.json')
+        self.tracker = ProgressTracker(self.status_path, 2)
+        self.batches = [FakeBatch(str(index), 2) for index in range(3)]
+        for batch in self.batches:
+            self.tracker.batch_queued(batch)
+        # First batch done, second failed, third still running.
+        for batch, state in zip(self.batches, ('done', 'failed', None)):
+            batch.start_time = self.tracker.start_time
+            self.tracker.batch_started(batch)
+            if state is not None:
+                batch.end_time = batch.start_time + 1.0
+                self.tracker.batch_finished(batch, state)
+        self.tracker.publish(0, 1, force=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.results_path)
+
+    def test_status_round_trip(self):
+        with open(self.status_path) as stream:
+            status = json.load(stream)
+        self.assertEqual(status, self.tracker.snapshot)
+        self.assertEqual(status['batches'], {
+            'queued': 0, 'running': 1, 'done': 1, 'failed': 1,
+            'resplit': 0, 'retried': 0})
+        self.assertEqual(status['image_sets'],
+                         {'total': 6, 'done': 2, 'failed': 2})
+        self.assertEqual([worker['batch'] for worker in status['workers']],
+                         ['2', None])
+        self.assertFalse(os.path.exists(self.status_path + '.tmp'))
+
+    def test_format_metrics(self):
+        lines = self.tracker.format_metrics().splitlines()
+        for line in (
+                '# TYPE parcp_batches gauge',
+                'parcp_batches{state="queued"} 0',
+                'parcp_batches{state="running"} 1',
+                '# TYPE parcp_batches_finished_total counter',
+                'parcp_batches_finished_total{state="done"} 1',
+                'parcp_batches_finished_total{state="failed"} 1',
+                'parcp_batches_finished_total{state="resplit"} 0',
+                '# TYPE parcp_image_sets gauge',
+                'parcp_image_sets 6',
+                '# TYPE parcp_image_sets_processed_total counter',
+                'parcp_image_sets_processed_total{state="done"} 2',
+                'parcp_image_sets_processed_total{state="failed"} 2'):
+            self.assertTrue(line in lines, line)
+        # Finished outcomes are not mixed into the gauge family.
+        self.assertFalse(any(line.startswith('parcp_batches{state="done"')
+                             for line in lines))
+
+    def test_metrics_server(self):
+        server = MetricsServer(self.tracker, 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % \
+                server.server.server_address[1]
+            body = urlopen(url).read().decode('utf-8')
+        finally:
+            server.stop()
+        self.assertEqual(body, self.tracker.format_metrics())